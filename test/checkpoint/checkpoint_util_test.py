@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import torch
+import torch.distributed as dist
+from distributed.collectives_test import run_in_process_group
+from torchelastic.checkpoint import (
+    CheckpointUtil,
+    FileSystemCheckpointManager,
+    set_checkpoint_manager,
+)
+from torchelastic.state import State
+
+
+class _SimpleState(State):
+    def __init__(self):
+        self.step = 0
+        self.weights = torch.zeros(16)
+
+    def sync(self, world_size, rank):
+        pass
+
+    def capture_snapshot(self):
+        return {"step": self.step, "weights": self.weights.clone()}
+
+    def apply_snapshot(self, snapshot):
+        self.step = snapshot["step"]
+        self.weights = snapshot["weights"]
+
+    def should_save_checkpoint(self, rank):
+        return True
+
+
+class _ShardedState(State):
+    def __init__(self):
+        self.entries = {}
+
+    def sync(self, world_size, rank):
+        pass
+
+    def capture_snapshot(self):
+        return dict(self.entries)
+
+    def apply_snapshot(self, snapshot):
+        self.entries = snapshot
+
+    def should_save_checkpoint(self, rank):
+        return True
+
+
+class _BarrierCoordinator:
+    def should_save_checkpoint(self):
+        return True
+
+    def barrier(self):
+        dist.barrier()
+
+
+def _make_entries():
+    # entries of different sizes so that shards are not trivially balanced
+    return {
+        "entry_{}".format(i): torch.arange(i * 10, dtype=torch.float) for i in range(7)
+    }
+
+
+def _save_sharded(rank, world_size, checkpoint_dir):
+    set_checkpoint_manager(FileSystemCheckpointManager(checkpoint_dir), sharded=True)
+    state = _ShardedState()
+    state.entries = _make_entries()
+    CheckpointUtil(_BarrierCoordinator()).save_checkpoint(state, rank)
+    return rank
+
+
+def _load_sharded(rank, world_size, checkpoint_dir):
+    set_checkpoint_manager(FileSystemCheckpointManager(checkpoint_dir), sharded=True)
+    state = CheckpointUtil(_BarrierCoordinator()).load_checkpoint(_ShardedState(), rank)
+    return {k: v.tolist() for k, v in state.entries.items()}
+
+
+class _FailingCheckpointManager(FileSystemCheckpointManager):
+    def create_checkpoint(self):
+        raise IOError("disk full")
+
+
+def _load_latest(checkpoint_manager):
+    state = _SimpleState()
+    checkpoint = checkpoint_manager.get_latest_checkpoint()
+    with checkpoint.open_input_stream("default") as stream:
+        state.load(stream)
+    return state
+
+
+class CheckpointUtilTest(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.TemporaryDirectory()  # noqa
+        self.coordinator = MagicMock()
+        self.coordinator.should_save_checkpoint.return_value = False
+
+    def tearDown(self):
+        set_checkpoint_manager(None)
+        self.test_dir.cleanup()
+
+    def test_save_checkpoint(self):
+        checkpoint_manager = FileSystemCheckpointManager(self.test_dir.name)
+        set_checkpoint_manager(checkpoint_manager)
+        checkpoint_util = CheckpointUtil(self.coordinator)
+
+        state = _SimpleState()
+        state.step = 7
+        checkpoint_util.save_checkpoint(state, rank=0)
+
+        self.assertEqual(1, len(checkpoint_manager.list_checkpoints()))
+        self.assertEqual(7, _load_latest(checkpoint_manager).step)
+        self.coordinator.barrier.assert_called_once()
+
+    def test_async_save_checkpoint(self):
+        checkpoint_manager = FileSystemCheckpointManager(self.test_dir.name)
+        set_checkpoint_manager(checkpoint_manager, async_save=True)
+        checkpoint_util = CheckpointUtil(self.coordinator)
+
+        state = _SimpleState()
+        for step in range(1, 4):
+            state.step = step
+            state.weights.fill_(step)
+            checkpoint_util.save_checkpoint(state, rank=0)
+            # mutating the state after save must not affect the checkpoint
+            state.weights.fill_(-1)
+
+        checkpoint_util.wait_for_pending_save()
+        self.assertEqual(3, len(checkpoint_manager.list_checkpoints()))
+        loaded = _load_latest(checkpoint_manager)
+        self.assertEqual(3, loaded.step)
+        self.assertTrue(torch.equal(torch.full((16,), 3.0), loaded.weights))
+
+    def test_async_save_checkpoint_non_zero_rank(self):
+        checkpoint_manager = FileSystemCheckpointManager(self.test_dir.name)
+        set_checkpoint_manager(checkpoint_manager, async_save=True)
+        checkpoint_util = CheckpointUtil(self.coordinator)
+
+        checkpoint_util.save_checkpoint(_SimpleState(), rank=1)
+        checkpoint_util.wait_for_pending_save()
+        self.assertEqual(0, len(checkpoint_manager.list_checkpoints()))
+        self.coordinator.barrier.assert_called_once()
+
+    def test_async_save_checkpoint_failure(self):
+        set_checkpoint_manager(
+            _FailingCheckpointManager(self.test_dir.name), async_save=True
+        )
+        checkpoint_util = CheckpointUtil(self.coordinator)
+
+        # the failure surfaces on the next call that waits for the write
+        checkpoint_util.save_checkpoint(_SimpleState(), rank=0)
+        with self.assertRaisesRegex(IOError, "disk full"):
+            checkpoint_util.wait_for_pending_save()
+
+        # a failed write is only reported once
+        checkpoint_util.wait_for_pending_save()
+
+    def test_sharded_save_and_reshard_on_load(self):
+        checkpoint_dir = self.test_dir.name
+        run_in_process_group(3, _save_sharded, checkpoint_dir)
+
+        checkpoint_manager = FileSystemCheckpointManager(checkpoint_dir)
+        checkpoint = checkpoint_manager.get_latest_checkpoint()
+        with checkpoint.open_input_stream("manifest") as stream:
+            manifest = json.loads(stream.read().decode("utf-8"))
+        self.assertEqual(3, manifest["world_size"])
+        self.assertEqual(["shard_0", "shard_1", "shard_2"], manifest["shards"])
+
+        # load with a different world size than the one that saved
+        q = run_in_process_group(2, _load_sharded, checkpoint_dir)
+        expected = {k: v.tolist() for k, v in _make_entries().items()}
+        results = []
+        while not q.empty():
+            results.append(q.get())
+        self.assertEqual([expected, expected], results)
+
+    def test_sharded_load_of_unsharded_checkpoint(self):
+        checkpoint_manager = FileSystemCheckpointManager(self.test_dir.name)
+        set_checkpoint_manager(checkpoint_manager)
+        state = _ShardedState()
+        state.entries = _make_entries()
+        CheckpointUtil(self.coordinator).save_checkpoint(state, rank=0)
+
+        set_checkpoint_manager(checkpoint_manager, sharded=True)
+        loaded = CheckpointUtil(self.coordinator).load_checkpoint(
+            _ShardedState(), rank=0
+        )
+        self.assertEqual(sorted(state.entries.keys()), sorted(loaded.entries.keys()))
+
+    def test_sharded_async_save_not_supported(self):
+        with self.assertRaises(ValueError):
+            set_checkpoint_manager(
+                FileSystemCheckpointManager(self.test_dir.name),
+                async_save=True,
+                sharded=True,
+            )
+
+    def _save_incremental(self, checkpoint_util, state, frozen, step):
+        state.entries = {"frozen": frozen, "step": torch.tensor([step])}
+        checkpoint_util.save_checkpoint(state, rank=0)
+
+    def _get_chunks_size(self, sequence_id):
+        path = os.path.join(self.test_dir.name, str(sequence_id), "chunks")
+        return os.path.getsize(path)
+
+    @patch("torchelastic.checkpoint.incremental._CHUNK_SIZE", 64)
+    def test_incremental_save_and_load_checkpoint(self):
+        checkpoint_manager = FileSystemCheckpointManager(self.test_dir.name)
+        set_checkpoint_manager(checkpoint_manager, incremental=True)
+        checkpoint_util = CheckpointUtil(self.coordinator)
+
+        state = _ShardedState()
+        frozen = torch.arange(1024, dtype=torch.float)
+        for step in range(3):
+            self._save_incremental(checkpoint_util, state, frozen, step)
+
+        # only the changed step is written after the first checkpoint
+        self.assertEqual(4096 + 8, self._get_chunks_size(0))
+        self.assertEqual(8, self._get_chunks_size(1))
+        self.assertEqual(8, self._get_chunks_size(2))
+
+        # a new CheckpointUtil (e.g. after a restart) restores the latest state
+        loaded = CheckpointUtil(self.coordinator).load_checkpoint(
+            _ShardedState(), rank=0
+        )
+        self.assertTrue(torch.equal(frozen, loaded.entries["frozen"]))
+        self.assertEqual([2], loaded.entries["step"].tolist())
+
+    @patch("torchelastic.checkpoint.incremental._CHUNK_SIZE", 64)
+    def test_incremental_checkpoint_max_delta_depth(self):
+        checkpoint_manager = FileSystemCheckpointManager(
+            self.test_dir.name, max_to_keep=2
+        )
+        set_checkpoint_manager(checkpoint_manager, incremental=True, max_delta_depth=2)
+        checkpoint_util = CheckpointUtil(self.coordinator)
+
+        state = _ShardedState()
+        frozen = torch.arange(1024, dtype=torch.float)
+        for step in range(4):
+            self._save_incremental(checkpoint_util, state, frozen, step)
+        checkpoint_manager._gc_executor.shutdown(wait=True)
+
+        # data is rewritten once it would be referenced from max_delta_depth ago
+        self.assertEqual(8, self._get_chunks_size(3))
+        self.assertEqual(4096 + 8, self._get_chunks_size(2))
+        loaded = CheckpointUtil(self.coordinator).load_checkpoint(
+            _ShardedState(), rank=0
+        )
+        self.assertTrue(torch.equal(frozen, loaded.entries["frozen"]))
+        self.assertEqual([3], loaded.entries["step"].tolist())
+
+    def test_incremental_options(self):
+        checkpoint_manager = FileSystemCheckpointManager(self.test_dir.name)
+        with self.assertRaises(ValueError):
+            set_checkpoint_manager(checkpoint_manager, incremental=True, sharded=True)
+        with self.assertRaises(ValueError):
+            set_checkpoint_manager(
+                checkpoint_manager, incremental=True, max_delta_depth=0
+            )
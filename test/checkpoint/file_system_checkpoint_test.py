@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+import os
+import tempfile
+import unittest
+
+from torchelastic.checkpoint import FileSystemCheckpointManager
+
+
+def _commit_checkpoint(checkpoint_manager, data=b"data"):
+    checkpoint = checkpoint_manager.create_checkpoint()
+    with checkpoint.open_output_stream("default") as stream:
+        stream.write(data)
+    checkpoint.commit()
+    return checkpoint
+
+
+class FileSystemCheckpointManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.TemporaryDirectory()  # noqa
+        self.checkpoint_dir = self.test_dir.name
+
+    def tearDown(self):
+        self.test_dir.cleanup()
+
+    def _read_index(self):
+        with open(os.path.join(self.checkpoint_dir, "index.json")) as f:
+            return json.load(f)["sequence_ids"]
+
+    def test_empty_checkpoint_dir(self):
+        checkpoint_manager = FileSystemCheckpointManager(self.checkpoint_dir)
+        self.assertIsNone(checkpoint_manager.get_latest_checkpoint())
+        self.assertEqual([], checkpoint_manager.list_checkpoints())
+
+    def test_commit_updates_index(self):
+        checkpoint_manager = FileSystemCheckpointManager(self.checkpoint_dir)
+        for _ in range(3):
+            _commit_checkpoint(checkpoint_manager)
+
+        self.assertEqual([0, 1, 2], self._read_index())
+        self.assertEqual(2, checkpoint_manager.get_latest_checkpoint().sequence_id)
+        self.assertEqual(
+            [2, 1, 0], [c.sequence_id for c in checkpoint_manager.list_checkpoints()]
+        )
+
+    def test_uncommitted_checkpoint_not_latest(self):
+        checkpoint_manager = FileSystemCheckpointManager(self.checkpoint_dir)
+        _commit_checkpoint(checkpoint_manager)
+        uncommitted = checkpoint_manager.create_checkpoint()
+
+        self.assertEqual(0, checkpoint_manager.get_latest_checkpoint().sequence_id)
+        # the uncommitted folder is never handed out again
+        next_checkpoint = checkpoint_manager.create_checkpoint()
+        self.assertEqual(uncommitted.sequence_id + 1, next_checkpoint.sequence_id)
+
+    def test_index_legacy_checkpoint_dir(self):
+        for seq_id in [0, 1, 5]:
+            os.mkdir(os.path.join(self.checkpoint_dir, str(seq_id)))
+
+        checkpoint_manager = FileSystemCheckpointManager(self.checkpoint_dir)
+        self.assertEqual(5, checkpoint_manager.get_latest_checkpoint().sequence_id)
+        self.assertEqual([0, 1, 5], self._read_index())
+        self.assertEqual(6, _commit_checkpoint(checkpoint_manager).sequence_id)
+
+    def test_max_to_keep(self):
+        checkpoint_manager = FileSystemCheckpointManager(
+            self.checkpoint_dir, max_to_keep=2
+        )
+        for _ in range(4):
+            _commit_checkpoint(checkpoint_manager)
+        # wait for the background deletes to finish
+        checkpoint_manager._gc_executor.shutdown(wait=True)
+
+        self.assertEqual([2, 3], self._read_index())
+        for seq_id in [0, 1]:
+            self.assertFalse(
+                os.path.exists(os.path.join(self.checkpoint_dir, str(seq_id)))
+            )
+        for seq_id in [2, 3]:
+            self.assertTrue(
+                os.path.isdir(os.path.join(self.checkpoint_dir, str(seq_id)))
+            )
+
+    def test_invalid_max_to_keep(self):
+        with self.assertRaises(ValueError):
+            FileSystemCheckpointManager(self.checkpoint_dir, max_to_keep=0)
+
+    def test_commit_is_atomic(self):
+        checkpoint_manager = FileSystemCheckpointManager(self.checkpoint_dir)
+        checkpoint = checkpoint_manager.create_checkpoint()
+        with checkpoint.open_output_stream("default") as stream:
+            stream.write(b"data")
+
+        # nothing is visible under the sequence id before the commit
+        self.assertFalse(os.path.exists(os.path.join(self.checkpoint_dir, "0")))
+        self.assertIsNone(checkpoint_manager.get_latest_checkpoint())
+        # other workers can write to the uncommitted checkpoint
+        other = checkpoint_manager.get_checkpoint(checkpoint.sequence_id)
+        with other.open_output_stream("shard_1") as stream:
+            stream.write(b"shard")
+
+        checkpoint.commit()
+        checkpoint_path = os.path.join(self.checkpoint_dir, "0")
+        self.assertEqual(
+            ["_COMPLETE", "default", "shard_1"], sorted(os.listdir(checkpoint_path))
+        )
+        latest = checkpoint_manager.get_latest_checkpoint()
+        with latest.open_input_stream("shard_1") as stream:
+            self.assertEqual(b"shard", stream.read())
+
+    def test_discard(self):
+        checkpoint_manager = FileSystemCheckpointManager(self.checkpoint_dir)
+        _commit_checkpoint(checkpoint_manager)
+        checkpoint = checkpoint_manager.create_checkpoint()
+        with checkpoint.open_output_stream("default") as stream:
+            stream.write(b"partial")
+        checkpoint.discard()
+
+        self.assertEqual(["0", "index.json"], sorted(os.listdir(self.checkpoint_dir)))
+        self.assertEqual(0, checkpoint_manager.get_latest_checkpoint().sequence_id)
+
+    def test_latest_skips_incomplete_checkpoint(self):
+        checkpoint_manager = FileSystemCheckpointManager(self.checkpoint_dir)
+        _commit_checkpoint(checkpoint_manager)
+        _commit_checkpoint(checkpoint_manager)
+        # simulate a checkpoint that lost its data (e.g. partially deleted)
+        os.remove(os.path.join(self.checkpoint_dir, "1", "_COMPLETE"))
+
+        self.assertEqual(0, checkpoint_manager.get_latest_checkpoint().sequence_id)
+        self.assertEqual(
+            [0], [c.sequence_id for c in checkpoint_manager.list_checkpoints()]
+        )
+        self.assertEqual(2, checkpoint_manager.create_checkpoint().sequence_id)
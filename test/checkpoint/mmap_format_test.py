@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+
+import io
+import os
+import tempfile
+import unittest
+
+import torch
+from torchelastic.checkpoint import FileSystemCheckpointManager, mmap_format
+
+
+def _make_snapshot():
+    return {
+        "step": 10,
+        "model": {
+            "weight": torch.nn.Parameter(torch.randn(4, 3)),
+            "bias": torch.arange(3, dtype=torch.int64),
+            # non contiguous
+            "transposed": torch.randn(3, 5).t(),
+        },
+        "masks": [torch.tensor([True, False]), torch.zeros(0), torch.tensor(1.5)],
+        "half": torch.ones(7, dtype=torch.float16),
+    }
+
+
+class MmapFormatTest(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.TemporaryDirectory()  # noqa
+
+    def tearDown(self):
+        self.test_dir.cleanup()
+
+    def assert_snapshot_equal(self, expected, actual):
+        self.assertEqual(expected["step"], actual["step"])
+        for key, tensor in expected["model"].items():
+            self.assertTrue(torch.equal(tensor, actual["model"][key]), key)
+        for e, a in zip(expected["masks"], actual["masks"]):
+            self.assertEqual(e.dtype, a.dtype)
+            self.assertTrue(torch.equal(e, a))
+        self.assertEqual(torch.float16, actual["half"].dtype)
+        self.assertTrue(torch.equal(expected["half"].float(), actual["half"].float()))
+
+    def test_save_load_file(self):
+        snapshot = _make_snapshot()
+        path = os.path.join(self.test_dir.name, "snapshot")
+        with open(path, "wb") as f:
+            mmap_format.save(snapshot, f)
+        with open(path, "rb") as f:
+            loaded = mmap_format.load(f)
+
+        self.assert_snapshot_equal(snapshot, loaded)
+        weight = loaded["model"]["weight"]
+        self.assertIsInstance(weight, torch.nn.Parameter)
+        self.assertTrue(weight.requires_grad)
+        # backed by the mapped file
+        if os.path.exists("/proc/self/maps"):
+            with open("/proc/self/maps") as f:
+                self.assertIn(path, f.read())
+
+        # modifying a loaded tensor does not modify the checkpoint
+        loaded["model"]["bias"].fill_(-1)
+        with open(path, "rb") as f:
+            reloaded = mmap_format.load(f)
+        self.assertTrue(
+            torch.equal(snapshot["model"]["bias"], reloaded["model"]["bias"])
+        )
+
+    def test_save_load_in_memory_stream(self):
+        snapshot = _make_snapshot()
+        buffer = io.BytesIO()
+        mmap_format.save(snapshot, buffer)
+        buffer.seek(0)
+        self.assert_snapshot_equal(snapshot, mmap_format.load(buffer))
+
+    def test_save_load_without_tensors(self):
+        buffer = io.BytesIO()
+        mmap_format.save({"step": 1}, buffer)
+        buffer.seek(0)
+        self.assertEqual({"step": 1}, mmap_format.load(buffer))
+
+    def test_load_torch_save_format(self):
+        buffer = io.BytesIO()
+        torch.save({"step": 1}, buffer)
+        buffer.seek(0)
+        with self.assertRaises(ValueError):
+            mmap_format.load(buffer)
+
+    def test_file_system_checkpoint(self):
+        snapshot = _make_snapshot()
+        checkpoint_manager = FileSystemCheckpointManager(self.test_dir.name)
+        checkpoint = checkpoint_manager.create_checkpoint()
+        with checkpoint.open_output_stream("default") as stream:
+            mmap_format.save(snapshot, stream)
+        checkpoint.commit()
+
+        checkpoint = checkpoint_manager.get_latest_checkpoint()
+        with checkpoint.open_input_stream("default") as stream:
+            loaded = mmap_format.load(stream)
+        # tensors remain valid after the stream is closed
+        self.assert_snapshot_equal(snapshot, loaded)
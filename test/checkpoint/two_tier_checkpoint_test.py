@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+
+import tempfile
+import unittest
+
+from torchelastic.checkpoint import (
+    FileSystemCheckpointManager,
+    TwoTierCheckpointManager,
+)
+
+
+def _commit_checkpoint(checkpoint_manager, data):
+    checkpoint = checkpoint_manager.create_checkpoint()
+    with checkpoint.open_output_stream("default") as stream:
+        stream.write(data)
+    checkpoint.commit()
+    return checkpoint
+
+
+def _read(checkpoint):
+    with checkpoint.open_input_stream("default") as stream:
+        return stream.read()
+
+
+class TwoTierCheckpointManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.local_dir = tempfile.TemporaryDirectory()  # noqa
+        self.durable_dir = tempfile.TemporaryDirectory()  # noqa
+
+    def tearDown(self):
+        self.local_dir.cleanup()
+        self.durable_dir.cleanup()
+
+    def _create_manager(self, **kwargs):
+        return TwoTierCheckpointManager(
+            self.local_dir.name, self.durable_dir.name, **kwargs
+        )
+
+    def test_commit_and_drain(self):
+        checkpoint_manager = self._create_manager()
+        for i in range(3):
+            _commit_checkpoint(checkpoint_manager, str(i).encode())
+        checkpoint_manager.wait_for_drain()
+        checkpoint_manager.local_checkpoint_manager._gc_executor.shutdown(wait=True)
+
+        durable_latest = FileSystemCheckpointManager(
+            self.durable_dir.name
+        ).get_latest_checkpoint()
+        self.assertEqual(2, durable_latest.sequence_id)
+        self.assertEqual(b"2", _read(durable_latest))
+        # drained checkpoints but the latest one are removed from the local tier
+        self.assertEqual(
+            [2],
+            [
+                c.sequence_id
+                for c in checkpoint_manager.local_checkpoint_manager.list_checkpoints()
+            ],
+        )
+        self.assertEqual(b"2", _read(checkpoint_manager.get_latest_checkpoint()))
+
+    def test_restore_from_local_tier_when_newer(self):
+        checkpoint_manager = self._create_manager()
+        _commit_checkpoint(checkpoint_manager, b"0")
+        checkpoint_manager.wait_for_drain()
+        # simulate a process that died before the drain of the next checkpoint
+        local_checkpoint = (
+            checkpoint_manager.local_checkpoint_manager.create_checkpoint()
+        )
+        with local_checkpoint.open_output_stream("default") as stream:
+            stream.write(b"1")
+        local_checkpoint.commit()
+
+        restarted = self._create_manager()
+        latest = restarted.get_latest_checkpoint()
+        self.assertEqual(1, latest.sequence_id)
+        self.assertEqual(b"1", _read(latest))
+        # and the local checkpoint is drained on restart
+        restarted.wait_for_drain()
+        durable_latest = FileSystemCheckpointManager(
+            self.durable_dir.name
+        ).get_latest_checkpoint()
+        self.assertEqual(1, durable_latest.sequence_id)
+
+    def test_restore_from_durable_tier_on_new_host(self):
+        checkpoint_manager = self._create_manager()
+        _commit_checkpoint(checkpoint_manager, b"0")
+        checkpoint_manager.wait_for_drain()
+
+        with tempfile.TemporaryDirectory() as new_local_dir:
+            new_host = TwoTierCheckpointManager(new_local_dir, self.durable_dir.name)
+            latest = new_host.get_latest_checkpoint()
+            self.assertEqual(0, latest.sequence_id)
+            self.assertEqual(b"0", _read(latest))
+            # sequence ids continue after the durable tier
+            self.assertEqual(1, new_host.create_checkpoint().sequence_id)
@@ -153,11 +153,13 @@ class ElasticTrainerTestBase(TestCommon, abc.ABC):
             _, elastic_coordinator, train_step, hooks, state_override
         )
 
-    def _train_with_checkpoint(self, _, run_id, train_step, hooks, state_override=None):
+    def _train_with_checkpoint(
+        self, _, run_id, train_step, hooks, state_override=None, sharded=False
+    ):
         """
         Train with checkpoint loading/saving
         """
-        with test_checkpoint_manager(self.test_dir.name):
+        with test_checkpoint_manager(self.test_dir.name, sharded=sharded):
             elastic_coordinator = TestCoordinatorP2P(
                 c10d_backend="gloo",
                 init_method=self.get_rdzv_url(run_id, self.min_size, self.max_size),
@@ -601,7 +603,16 @@ class ElasticTrainerTestBase(TestCommon, abc.ABC):
             - Trainers suicide at 3rd step
             - Restart training (from checkpoint)
         """
+        self._do_test_checkpoint(sharded=False)
+
+    def test_checkpoint_sharded(self):
+        """
+        Same as ``test_checkpoint`` but all trainers save and load
+        a shard of the checkpoint.
+        """
+        self._do_test_checkpoint(sharded=True)
 
+    def _do_test_checkpoint(self, sharded):
         def process_crash():
             log.warning("Suicide, pid:{}".format(os.getpid()))
             os.kill(os.getpid(), signal.SIGKILL)
@@ -617,7 +628,7 @@ class ElasticTrainerTestBase(TestCommon, abc.ABC):
 
         for _ in range(0, nprocs):
             _, qout, qerr = self._spawn(
-                self._train_with_checkpoint, run_id, _train_step, hooks
+                self._train_with_checkpoint, run_id, _train_step, hooks, None, sharded
             )
 
         # wait all training process complete
@@ -632,7 +643,7 @@ class ElasticTrainerTestBase(TestCommon, abc.ABC):
         # start next run
         for _ in range(0, nprocs):
             _, qout, qerr = self._spawn(
-                self._train_with_checkpoint, run_id, _train_step, None
+                self._train_with_checkpoint, run_id, _train_step, None, None, sharded
             )
             qouts.append(qout)
             qerrs.append(qerr)
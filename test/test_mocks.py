@@ -176,11 +176,11 @@ class TestWorkerStats(WorkerStats):
 
 
 @contextmanager
-def test_checkpoint_manager(checkpoint_folder):
+def test_checkpoint_manager(checkpoint_folder, **checkpoint_options):
     # Code to acquire resource, e.g.:
     checkpoint_manager = FileSystemCheckpointManager(checkpoint_folder)
     old_checkpoint_manager = get_checkpoint_manager()
-    set_checkpoint_manager(checkpoint_manager)
+    set_checkpoint_manager(checkpoint_manager, **checkpoint_options)
     yield
     set_checkpoint_manager(old_checkpoint_manager)
 
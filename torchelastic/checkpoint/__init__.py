@@ -14,3 +14,5 @@ from .api import (  # noqa F401
     set_checkpoint_manager,
 )
 from .file_system_checkpoint import FileSystemCheckpointManager  # noqa F401
+from . import mmap_format  # noqa F401
+from .two_tier_checkpoint import TwoTierCheckpointManager  # noqa F401
@@ -7,23 +7,83 @@
 # LICENSE file in the root directory of this source tree.
 
 import abc
+import io
+import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
+import numpy
+import torch
 import torchelastic.distributed as edist
 import torchelastic.metrics as metrics
 
+from .incremental import (
+    load_incremental_checkpoint,
+    read_delta_manifest,
+    save_incremental_checkpoint,
+)
+
 
 log = logging.getLogger(__name__)
 
 _DEFAULT_CHECKPOINT_KEY = "default"
 
+# Sharded checkpoints store a manifest under this key plus one key per shard.
+_MANIFEST_CHECKPOINT_KEY = "manifest"
+_SHARDED_CHECKPOINT_VERSION = 1
+
+_DEFAULT_MAX_DELTA_DEPTH = 8
+
 _CHECKPOINT_MANAGER = None
 
+_CHECKPOINT_OPTIONS = {}
+
+
+def set_checkpoint_manager(
+    checkpoint_manager,
+    async_save=False,
+    sharded=False,
+    incremental=False,
+    max_delta_depth=_DEFAULT_MAX_DELTA_DEPTH,
+):
+    """
+    Sets the checkpoint manager used by the train loop.
+
+    ``async_save`` - when ``True`` the state is serialized into memory
+                     on rank 0 and written to ``checkpoint_manager`` by a
+                     background thread, so that training resumes without
+                     waiting on storage. At most one write is in flight
+                     at any time.
+    ``sharded``    - when ``True`` every rank writes and reads a shard of the
+                     state's snapshot in parallel (see ``CheckpointUtil``).
+                     Requires ``state.capture_snapshot()`` to return a dict.
+    ``incremental`` - when ``True`` rank 0 only writes the chunks of the
+                     tensors in ``state.capture_snapshot()`` that changed
+                     since the previous checkpoint (see ``incremental.py``).
+    ``max_delta_depth`` - an incremental checkpoint only references data
+                     from the previous ``max_delta_depth - 1`` sequence ids.
+                     Checkpoint managers must retain at least this many
+                     checkpoints.
+    """
+    if async_save and sharded:
+        raise ValueError("async_save is not supported for sharded checkpoints")
+    if incremental and (async_save or sharded):
+        raise ValueError(
+            "incremental checkpoints cannot be combined with async_save or sharded"
+        )
+    if max_delta_depth < 1:
+        raise ValueError("max_delta_depth must be at least 1")
 
-def set_checkpoint_manager(checkpoint_manager):
     global _CHECKPOINT_MANAGER
+    global _CHECKPOINT_OPTIONS
     _CHECKPOINT_MANAGER = checkpoint_manager
+    _CHECKPOINT_OPTIONS = {
+        "async_save": async_save,
+        "sharded": sharded,
+        "incremental": incremental,
+        "max_delta_depth": max_delta_depth,
+    }
 
 
 def get_checkpoint_manager():
@@ -31,6 +91,10 @@ def get_checkpoint_manager():
     return _CHECKPOINT_MANAGER
 
 
+def get_checkpoint_options():
+    return _CHECKPOINT_OPTIONS
+
+
 class _CheckpointBarrier(object):
     """
     Checkpoint Barrier
@@ -51,11 +115,121 @@ class _CheckpointBarrier(object):
         log.info(f"Rank {self.rank} exit checkpoint barrier")
 
 
+class _AsyncCheckpointWriter(object):
+    """
+    Writes in-memory checkpoint data to the checkpoint manager on a
+    background thread. At most one write is in flight at any time;
+    submitting a new write blocks until the previous one has finished.
+    """
+
+    def __init__(self, checkpoint_manager):
+        self.checkpoint_manager = checkpoint_manager
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending_write = None
+
+    def submit(self, data):
+        self.wait()
+        self._pending_write = self._executor.submit(self._write, data)
+
+    def wait(self):
+        """
+        Blocks until the in-flight write (if any) is committed. Re-raises
+        the exception if the write failed.
+        """
+        pending_write, self._pending_write = self._pending_write, None
+        if pending_write is not None:
+            pending_write.result()
+
+    @metrics.profile("torchelastic")
+    def _write(self, data):
+        checkpoint = None
+        try:
+            checkpoint = self.checkpoint_manager.create_checkpoint()
+            with checkpoint.open_output_stream(_DEFAULT_CHECKPOINT_KEY) as stream:
+                stream.write(data)
+            checkpoint.commit()
+            log.info("Async checkpoint write committed.")
+        except Exception as e:
+            log.error("Async checkpoint write fail: {}".format(e))
+            if checkpoint:
+                checkpoint.discard()
+            raise e
+
+
+def _get_size_in_bytes(obj):
+    if torch.is_tensor(obj):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, dict):
+        return sum(_get_size_in_bytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(_get_size_in_bytes(v) for v in obj)
+    # non-tensor leaves are assumed to be small
+    return 0
+
+
+def _partition_snapshot(snapshot, num_shards):
+    """
+    Splits the top level entries of ``snapshot`` into ``num_shards``
+    lists of keys of roughly equal size in bytes. The partitioning is
+    deterministic so that every rank computes the same result.
+    """
+    if not isinstance(snapshot, dict):
+        raise ValueError(
+            "Sharded checkpoints require capture_snapshot() to return a dict,"
+            " got: {}".format(type(snapshot))
+        )
+
+    sizes = {key: _get_size_in_bytes(value) for key, value in snapshot.items()}
+    # place the largest entries first, each into the currently smallest shard
+    keys = sorted(snapshot.keys(), key=lambda k: (-sizes[k], str(k)))
+    shards = [[] for _ in range(num_shards)]
+    shard_sizes = [0] * num_shards
+    for key in keys:
+        i = shard_sizes.index(min(shard_sizes))
+        shards[i].append(key)
+        shard_sizes[i] += sizes[key]
+    return shards
+
+
+def _get_shard_key(shard_index):
+    return "shard_{}".format(shard_index)
+
+
 class CheckpointUtil:
+    """
+    Saves and loads checkpoints of the ``State`` on behalf of the train loop.
+
+    By default rank 0 writes the whole state (``state.save``) under a single
+    key and loads it back on restart; other ranks get the state through
+    ``state.sync``.
+
+    With ``sharded=True`` (see ``set_checkpoint_manager``) every rank takes
+    part in both operations. The entries of ``state.capture_snapshot()``
+    are partitioned by size across all ranks, each rank writes its own
+    shard concurrently and rank 0 commits a manifest listing the shards.
+    On load, the shards listed in the manifest are read round robin by
+    the ranks of the *current* world (which may be of a different size),
+    exchanged between ranks and applied with ``state.apply_snapshot``.
+
+    With ``incremental=True`` rank 0 writes ``state.capture_snapshot()``
+    as a delta against the previous checkpoint and restores it with
+    ``state.apply_snapshot``.
+    """
+
     def __init__(self, coordinator):
         self.coordinator = coordinator
         self.checkpoint_manager = get_checkpoint_manager()
         self.checkpoint_loaded = False
+        self.sharded = get_checkpoint_options().get("sharded", False)
+        self.incremental = get_checkpoint_options().get("incremental", False)
+        self._max_delta_depth = get_checkpoint_options().get(
+            "max_delta_depth", _DEFAULT_MAX_DELTA_DEPTH
+        )
+        # chunk table of the last incremental checkpoint saved or loaded
+        self._chunk_table = None
+        self._checkpoint_writer = None
+        if self.checkpoint_manager and get_checkpoint_options().get("async_save"):
+            self._checkpoint_writer = _AsyncCheckpointWriter(self.checkpoint_manager)
 
     def _do_load_checkpoint(self, state):
         """
@@ -69,6 +243,16 @@ class CheckpointUtil:
             if not checkpoint:
                 log.info("Cannot find a checkpoint to load.")
                 return state
+            manifest = read_delta_manifest(checkpoint) if self.incremental else None
+            if manifest is not None:
+                log.info("Loading incremental checkpoint...")
+                snapshot = load_incremental_checkpoint(
+                    self.checkpoint_manager, manifest
+                )
+                state.apply_snapshot(snapshot)
+                self._chunk_table = manifest["chunks"]
+                log.info("Load checkpoint successfully.")
+                return state
             else:
                 log.info("Loading checkpoint...")
                 with checkpoint.open_input_stream(_DEFAULT_CHECKPOINT_KEY) as stream:
@@ -90,11 +274,17 @@ class CheckpointUtil:
             # checkpoint not enabled
             return state
 
+        # a write started before the (re-)rendezvous must land before we
+        # look for the latest checkpoint, and before a different rank 0
+        # can start the next write
+        self.wait_for_pending_save()
+
         # all gather `checkpoint_loaded` from all trainers, return true
         # if any trainer have ever loaded checkpoint
-        any_checkpoint_loaded = (
-            edist.all_gather_return_max_long(1 if self.checkpoint_loaded else 0) == 1
+        _, max_checkpoint_loaded = edist.all_gather_return_max_long(
+            1 if self.checkpoint_loaded else 0
         )
+        any_checkpoint_loaded = max_checkpoint_loaded == 1
 
         if any_checkpoint_loaded:
             # checkpoint already loaded by one of the existing trainer
@@ -103,6 +293,9 @@ class CheckpointUtil:
         # we load checkpoint only if all trainers start from scratch. it is
         # not necessary to load checkpoint if there is a good trainer as new
         # trainer can sync state from it.
+        if self.sharded:
+            return self._do_load_sharded_checkpoint(state, rank)
+
         # Start with simple scenario, we always ask one single trainer to
         # load checkpoint and other trainer sync from it
         if rank == 0:
@@ -110,12 +303,98 @@ class CheckpointUtil:
 
         return state
 
+    def _read_manifest(self, checkpoint):
+        """
+        Returns the manifest of a sharded checkpoint or ``None`` if
+        ``checkpoint`` was written with a single (default) key.
+        """
+        try:
+            stream = checkpoint.open_input_stream(_MANIFEST_CHECKPOINT_KEY)
+        except Exception:
+            return None
+        with stream:
+            return json.loads(stream.read().decode("utf-8"))
+
+    def _do_load_sharded_checkpoint(self, state, rank):
+        """
+        Loads the latest checkpoint collectively, must be called on all ranks.
+        Falls back to loading the default key on rank 0 if the latest
+        checkpoint is not sharded.
+        """
+        world_size = edist.get_world_size()
+        # rank 0 decides which checkpoint to load, and whether it is sharded
+        checkpoint = None
+        manifest = None
+        sequence_id = -1
+        if rank == 0:
+            log.info("Finding latest available checkpoint...")
+            checkpoint = self.checkpoint_manager.get_latest_checkpoint()
+            if checkpoint:
+                sequence_id = checkpoint.sequence_id
+                manifest = self._read_manifest(checkpoint)
+        is_sharded = manifest is not None
+
+        sequence_id = edist.broadcast_long(sequence_id, 0)
+        is_sharded = edist.broadcast_bool(is_sharded, 0)
+        if sequence_id < 0:
+            log.info("Cannot find a checkpoint to load.")
+            return state
+
+        if not is_sharded:
+            if rank == 0:
+                state = self._do_load_checkpoint(state)
+            return state
+
+        try:
+            if checkpoint is None:
+                checkpoint = self.checkpoint_manager.get_checkpoint(sequence_id)
+                manifest = self._read_manifest(checkpoint)
+            shard_keys = manifest["shards"]
+            log.info(
+                "Loading sharded checkpoint {} ({} shards saved by world size {})"
+                " with world size {}...".format(
+                    sequence_id, len(shard_keys), manifest["world_size"], world_size
+                )
+            )
+
+            # read our shards as raw bytes, in parallel with the other ranks
+            data = {}
+            for i, shard_key in enumerate(shard_keys):
+                if i % world_size == rank:
+                    with checkpoint.open_input_stream(shard_key) as stream:
+                        data[shard_key] = numpy.frombuffer(
+                            bytearray(stream.read()), dtype=numpy.uint8
+                        )
+
+            # exchange the shards so that every rank sees all of them
+            snapshot = {}
+            for i, shard_key in enumerate(shard_keys):
+                shard_data = edist.broadcast_binary(
+                    data.get(shard_key), src_rank=i % world_size
+                )
+                snapshot.update(torch.load(io.BytesIO(shard_data.tobytes())))
+
+            state.apply_snapshot(snapshot)
+            log.info("Load sharded checkpoint successfully.")
+            return state
+        except Exception as e:
+            log.error("Load sharded checkpoint fail: {}".format(e))
+            raise e
+
     def set_checkpoint_loaded(self):
         """
         Indicate checkpoint have been loaded
         """
         self.checkpoint_loaded = True
 
+    def wait_for_pending_save(self):
+        """
+        Blocks until the checkpoint being written in the background (if any)
+        is committed. No-op unless ``async_save`` is enabled.
+        """
+        if self._checkpoint_writer:
+            self._checkpoint_writer.wait()
+
     def _do_save_checkpoint(self, state):
         """
         Save checkpoint.
@@ -128,15 +407,108 @@ class CheckpointUtil:
             with checkpoint.open_output_stream(_DEFAULT_CHECKPOINT_KEY) as stream:
                 # Start from simple with _DEFAULT_CHECKPOINT_KEY
                 state.save(stream)
-                log.info("Save Checkpoint successfully.")
-                checkpoint.commit()
+            checkpoint.commit()
+            log.info("Save Checkpoint successfully.")
         except Exception as e:
             log.error("Save checkpoint fail: {}".format(e))
-            if not checkpoint:
+            if checkpoint:
+                # discard bad checkpoint
+                checkpoint.discard()
+            raise e
+
+    def _get_previous_chunk_table(self):
+        if self._chunk_table is None:
+            checkpoint = self.checkpoint_manager.get_latest_checkpoint()
+            manifest = read_delta_manifest(checkpoint) if checkpoint else None
+            self._chunk_table = manifest["chunks"] if manifest else {}
+        return self._chunk_table
+
+    def _do_save_incremental_checkpoint(self, state):
+        """
+        Saves an incremental checkpoint on rank 0.
+        """
+        checkpoint = None
+        try:
+            previous_chunks = self._get_previous_chunk_table()
+            log.info("Creating new incremental checkpoint...")
+            checkpoint = self.checkpoint_manager.create_checkpoint()
+            chunk_table = save_incremental_checkpoint(
+                checkpoint,
+                state.capture_snapshot(),
+                previous_chunks,
+                self._max_delta_depth,
+            )
+            checkpoint.commit()
+            self._chunk_table = chunk_table
+            log.info("Save Checkpoint successfully.")
+        except Exception as e:
+            log.error("Save checkpoint fail: {}".format(e))
+            if checkpoint:
                 # discard bad checkpoint
                 checkpoint.discard()
             raise e
 
+    def _do_save_sharded_checkpoint(self, state, rank):
+        """
+        Saves a sharded checkpoint, must be called on all ranks.
+        """
+        world_size = edist.get_world_size()
+        checkpoint = None
+        try:
+            # rank 0 creates the checkpoint so that all shards land in it
+            sequence_id = -1
+            if rank == 0:
+                log.info("Creating new sharded checkpoint...")
+                checkpoint = self.checkpoint_manager.create_checkpoint()
+                sequence_id = checkpoint.sequence_id
+            sequence_id = edist.broadcast_long(sequence_id, 0)
+            if rank != 0:
+                checkpoint = self.checkpoint_manager.get_checkpoint(sequence_id)
+
+            snapshot = state.capture_snapshot()
+            shards = _partition_snapshot(snapshot, world_size)
+            log.info(
+                "Saving shard {}/{} of checkpoint {}...".format(
+                    rank, world_size, sequence_id
+                )
+            )
+            with checkpoint.open_output_stream(_get_shard_key(rank)) as stream:
+                torch.save({key: snapshot[key] for key in shards[rank]}, stream)
+
+            # the manifest must only be written once all shards are
+            self.coordinator.barrier()
+
+            if rank == 0:
+                manifest = {
+                    "version": _SHARDED_CHECKPOINT_VERSION,
+                    "world_size": world_size,
+                    "shards": [_get_shard_key(i) for i in range(world_size)],
+                }
+                with checkpoint.open_output_stream(_MANIFEST_CHECKPOINT_KEY) as stream:
+                    stream.write(json.dumps(manifest).encode("utf-8"))
+                checkpoint.commit()
+                log.info("Save sharded checkpoint successfully.")
+        except Exception as e:
+            log.error("Save sharded checkpoint fail: {}".format(e))
+            if rank == 0 and checkpoint:
+                # discard bad checkpoint
+                checkpoint.discard()
+            raise e
+
+    def _do_save_checkpoint_async(self, state):
+        """
+        Captures the state into memory and hands it off to the background
+        writer. Returns as soon as the state is captured.
+        """
+        # wait for the previous write first so that we never hold more
+        # than one in-memory copy of the state
+        self._checkpoint_writer.wait()
+        log.info("Capturing checkpoint in memory...")
+        buffer = io.BytesIO()
+        state.save(buffer)
+        self._checkpoint_writer.submit(buffer.getbuffer())
+        log.info("Checkpoint handed off to background writer.")
+
     @metrics.profile("torchelastic")
     def save_checkpoint(self, state, rank: int):
         """
@@ -158,8 +530,15 @@ class CheckpointUtil:
             # We come here, otherwise it will break out of the loop if any
             # exception is raised.
             with _CheckpointBarrier(rank, self.coordinator):
-                if rank == 0:
-                    self._do_save_checkpoint(state)
+                if self.sharded:
+                    self._do_save_sharded_checkpoint(state, rank)
+                elif rank == 0:
+                    if self.incremental:
+                        self._do_save_incremental_checkpoint(state)
+                    elif self._checkpoint_writer:
+                        self._do_save_checkpoint_async(state)
+                    else:
+                        self._do_save_checkpoint(state)
 
 
 class Checkpoint(abc.ABC):
@@ -168,6 +547,10 @@ class Checkpoint(abc.ABC):
     User don't need to know where to save the data and how to save the data.
     It provide a key/value storage and support both synchronize/streaming way
     to storage data.
+
+    Implementations are expected to expose the ``sequence_id`` attribute that
+    ``CheckpointManager.get_checkpoint`` accepts to open the same checkpoint
+    (e.g. from a different worker).
     """
 
     @abc.abstractmethod
@@ -6,81 +6,252 @@
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
 
+import json
 import logging
 import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from .api import Checkpoint, CheckpointManager
 
 
 log = logging.getLogger(__name__)
 
+# Name of the file (in the checkpoint dir) that indexes committed checkpoints.
+# It is not an integer hence never mistaken for a checkpoint folder.
+_INDEX_FILE_NAME = "index.json"
+_INDEX_VERSION = 1
+# Checkpoints are written to ``<sequence_id><_TMP_DIR_SUFFIX>`` and renamed to
+# ``<sequence_id>`` on commit, so a crash never leaves a partial checkpoint
+# under a sequence id folder.
+_TMP_DIR_SUFFIX = ".tmp"
+# Written (and fsync-ed) into the checkpoint folder right before the rename.
+_COMPLETE_MARKER = "_COMPLETE"
+
+
+def _is_int(input):
+    try:
+        int(input)
+    except ValueError:
+        return False
+    return True
+
+
+def _fsync_path(path):
+    # directories can be fsync-ed on POSIX (to persist the entries they hold)
+    # by opening them read-only
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 
 class FileSystemCheckpointManager(CheckpointManager):
     """
     A CheckpointManager that reads/writes checkpoints to
     the file system.
+
+    Checkpoints are written to a temporary folder which is renamed to the
+    sequence id of the checkpoint once all of its data and a completion
+    marker are persisted (see ``FileSystemCheckpoint.commit()``). Each
+    committed checkpoint is a folder named after its sequence id. The sequence ids
+    of committed checkpoints are kept in an index file that is atomically
+    replaced on every ``commit()``, so that finding the latest checkpoint
+    does not require listing the checkpoint dir (which can be slow on shared
+    file systems with many checkpoints). Checkpoint dirs written before the
+    index existed are indexed with a one-off directory scan.
+
+    ``max_to_keep`` - when set, only the latest ``max_to_keep`` committed
+                      checkpoints are retained. Older ones are dropped from
+                      the index on commit and deleted in the background.
     """
 
-    def __init__(self, checkpoint_dir):
+    def __init__(self, checkpoint_dir, max_to_keep=None):
+        if max_to_keep is not None and max_to_keep < 1:
+            raise ValueError("max_to_keep must be at least 1")
+
         self._checkpoint_dir = checkpoint_dir
+        self._max_to_keep = max_to_keep
+        self._index_path = os.path.join(checkpoint_dir, _INDEX_FILE_NAME)
+        self._index_lock = threading.Lock()
+        self._gc_executor = None
 
-    def _get_sequence_ids(self):
-        # r=root, d=directories, f = files
-        def _is_int(input):
-            try:
-                int(input)
-            except ValueError:
-                return False
-            return True
+    def _get_checkpoint_path(self, sequence_id):
+        return os.path.join(self._checkpoint_dir, str(sequence_id))
 
+    def _get_tmp_checkpoint_path(self, sequence_id):
+        return self._get_checkpoint_path(sequence_id) + _TMP_DIR_SUFFIX
+
+    def _is_complete(self, sequence_id):
+        marker_path = os.path.join(
+            self._get_checkpoint_path(sequence_id), _COMPLETE_MARKER
+        )
+        return os.path.isfile(marker_path)
+
+    def _scan_sequence_ids(self):
         dirs = []
         for entry_name in os.listdir(self._checkpoint_dir):
             entry_path = os.path.join(self._checkpoint_dir, entry_name)
-            if os.path.isdir(entry_path):
+            if _is_int(entry_name) and os.path.isdir(entry_path):
                 dirs.append(entry_name)
 
-        seq_ids = [int(id) for id in dirs if _is_int(id)]
-        # sort desc
-        seq_ids.sort(reverse=True)
+        seq_ids = [int(id) for id in dirs]
+        for seq_id in seq_ids:
+            if not self._is_complete(seq_id):
+                # written before checkpoints had a completion marker, there is
+                # no way to tell if it is complete so keep on trusting it
+                log.info(f"Marking legacy checkpoint {seq_id} as complete")
+                marker_path = os.path.join(
+                    self._get_checkpoint_path(seq_id), _COMPLETE_MARKER
+                )
+                open(marker_path, "wb").close()
         return seq_ids
 
+    def _read_index(self):
+        """
+        Returns the committed sequence ids (asc) from the index, or ``None``
+        if there is no index yet.
+        """
+        try:
+            with open(self._index_path, "r") as f:
+                return json.load(f)["sequence_ids"]
+        except FileNotFoundError:
+            return None
+
+    def _write_index(self, seq_ids):
+        tmp_path = "{}.{}.tmp".format(self._index_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump({"version": _INDEX_VERSION, "sequence_ids": seq_ids}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        # atomic on POSIX, readers see either the old or the new index
+        os.replace(tmp_path, self._index_path)
+
+    def _get_sequence_ids(self):
+        seq_ids = self._read_index()
+        if seq_ids is None:
+            with self._index_lock:
+                seq_ids = self._read_index()
+                if seq_ids is None:
+                    log.info(f"Indexing checkpoints in: {self._checkpoint_dir}")
+                    seq_ids = sorted(self._scan_sequence_ids())
+                    self._write_index(seq_ids)
+
+        # sort desc
+        return sorted(seq_ids, reverse=True)
+
+    def _on_commit(self, sequence_id):
+        with self._index_lock:
+            seq_ids = self._read_index()
+            if seq_ids is None:
+                seq_ids = self._scan_sequence_ids()
+            seq_ids = sorted(set(seq_ids) | {sequence_id})
+
+            expired_ids = []
+            if self._max_to_keep is not None and len(seq_ids) > self._max_to_keep:
+                expired_ids = seq_ids[: -self._max_to_keep]
+                seq_ids = seq_ids[-self._max_to_keep :]
+
+            self._write_index(seq_ids)
+
+        if expired_ids:
+            self._delete_in_background(expired_ids)
+
+    def _remove_checkpoints(self, seq_ids):
+        """
+        Removes the checkpoints from the index and deletes them in the background.
+        """
+        with self._index_lock:
+            seq_ids = set(seq_ids)
+            indexed_ids = self._read_index() or []
+            self._write_index([id for id in indexed_ids if id not in seq_ids])
+        self._delete_in_background(sorted(seq_ids))
+
+    def _delete_in_background(self, seq_ids):
+        if self._gc_executor is None:
+            self._gc_executor = ThreadPoolExecutor(max_workers=1)
+        self._gc_executor.submit(self._delete_checkpoints, seq_ids)
+
+    def _delete_checkpoints(self, seq_ids):
+        for seq_id in seq_ids:
+            path = os.path.join(self._checkpoint_dir, str(seq_id))
+            log.info(f"Deleting expired checkpoint: {path}")
+            shutil.rmtree(path, ignore_errors=True)
+
     def create_checkpoint(self):
         """
         create a new checkpoint
         """
+        return self._create_checkpoint()
+
+    def _create_checkpoint(self, min_sequence_id=0):
+        """
+        Creates a new checkpoint with a sequence id that is larger than the
+        latest one and at least ``min_sequence_id``.
+        """
         seq_ids = self._get_sequence_ids()
         next_id = 0 if len(seq_ids) == 0 else seq_ids[0] + 1
-        return FileSystemCheckpoint(next_id, self._checkpoint_dir)
+        next_id = max(next_id, min_sequence_id)
+        while True:
+            # skip over sequence ids of uncommitted (e.g. crashed) checkpoints,
+            # mkdir is atomic so concurrent callers never get the same id
+            if not os.path.exists(self._get_checkpoint_path(next_id)):
+                try:
+                    os.mkdir(self._get_tmp_checkpoint_path(next_id))
+                    break
+                except FileExistsError:
+                    pass
+            next_id += 1
+        return FileSystemCheckpoint(next_id, self._checkpoint_dir, self)
 
     def get_checkpoint(self, sequence_id):
-        current_folder = os.path.join(self._checkpoint_dir, str(sequence_id))
-        if not os.path.isdir(current_folder):
+        current_folder = self._get_checkpoint_path(sequence_id)
+        if not (
+            os.path.isdir(current_folder)
+            or os.path.isdir(self._get_tmp_checkpoint_path(sequence_id))
+        ):
             raise Exception("folder: {} not found".format(current_folder))
-        return FileSystemCheckpoint(sequence_id, self._checkpoint_dir)
+        return FileSystemCheckpoint(sequence_id, self._checkpoint_dir, self)
+
+    def _get_complete_sequence_ids(self):
+        # only stats the completion marker, incomplete checkpoints
+        # (e.g. deleted by hand) are skipped without opening them
+        return [id for id in self._get_sequence_ids() if self._is_complete(id)]
 
     def get_latest_checkpoint(self):
-        seq_ids = self._get_sequence_ids()
+        seq_ids = self._get_complete_sequence_ids()
         if len(seq_ids) == 0:
             return None
         else:
             return self.get_checkpoint(seq_ids[0])
 
     def list_checkpoints(self):
-        seq_ids = self._get_sequence_ids()
+        seq_ids = self._get_complete_sequence_ids()
         return [self.get_checkpoint(id) for id in seq_ids]
 
 
 class FileSystemCheckpoint(Checkpoint):
     """
     Represents a checkpoint in the local file system.
+
+    Until it is committed the checkpoint is written to a temporary folder.
     """
 
-    def __init__(self, sequence_id, checkpoint_dir):
-        self.checkpoint_dir = os.path.join(checkpoint_dir, str(sequence_id))
-        # Create target Directory if it doesn't exist
-        if not os.path.exists(self.checkpoint_dir):
-            os.mkdir(self.checkpoint_dir)
-            log.info(f"Created checkpoint dir: {self.checkpoint_dir}")
+    def __init__(self, sequence_id, checkpoint_dir, checkpoint_manager=None):
+        self.sequence_id = sequence_id
+        self._committed_dir = os.path.join(checkpoint_dir, str(sequence_id))
+        self._checkpoint_manager = checkpoint_manager
+        self._committed = os.path.isdir(self._committed_dir)
+        if self._committed:
+            self.checkpoint_dir = self._committed_dir
+        else:
+            self.checkpoint_dir = self._committed_dir + _TMP_DIR_SUFFIX
+            # Create target Directory if it doesn't exist
+            if not os.path.exists(self.checkpoint_dir):
+                os.mkdir(self.checkpoint_dir)
+                log.info(f"Created checkpoint dir: {self.checkpoint_dir}")
 
     def open_output_stream(self, key):
         path = os.path.join(self.checkpoint_dir, key)
@@ -93,7 +264,38 @@ class FileSystemCheckpoint(Checkpoint):
         return open(path, "rb")
 
     def commit(self):
-        pass
+        """
+        Persists all keys (written by any worker) with a single batch of
+        fsyncs, writes the completion marker and atomically renames the
+        temporary folder to the sequence id of the checkpoint.
+        """
+        if self._committed:
+            return
+
+        for entry_name in os.listdir(self.checkpoint_dir):
+            entry_path = os.path.join(self.checkpoint_dir, entry_name)
+            if os.path.isfile(entry_path):
+                _fsync_path(entry_path)
+        with open(os.path.join(self.checkpoint_dir, _COMPLETE_MARKER), "wb") as f:
+            os.fsync(f.fileno())
+        _fsync_path(self.checkpoint_dir)
+
+        os.rename(self.checkpoint_dir, self._committed_dir)
+        _fsync_path(os.path.dirname(self._committed_dir))
+        self.checkpoint_dir = self._committed_dir
+        self._committed = True
+        log.info(f"Committed checkpoint: {self.checkpoint_dir}")
+
+        if self._checkpoint_manager is not None:
+            self._checkpoint_manager._on_commit(self.sequence_id)
 
     def discard(self):
-        pass
+        """
+        Deletes the data of an uncommitted checkpoint. Committed checkpoints
+        are left untouched.
+        """
+        if self._committed:
+            log.warning(f"Not discarding committed checkpoint: {self.checkpoint_dir}")
+            return
+        log.info(f"Discarding checkpoint: {self.checkpoint_dir}")
+        shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Incremental (delta) checkpoints.
+
+The tensors of a snapshot are split into fixed size chunks that are keyed
+by the hash of their content. A checkpoint only stores the chunks that are
+not already stored by a recent earlier checkpoint (under the ``chunks`` key)
+plus a manifest (under the ``delta_manifest`` key) with the pickled snapshot,
+in which tensors are replaced by the hashes of their chunks, and a table
+that maps each referenced chunk to the checkpoint (sequence id) and offset
+holding its data.
+
+Chunks are only referenced from the last ``max_delta_depth`` sequence ids
+(counting the checkpoint being written), older ones are written again.
+Hence a checkpoint manager that retains (at least) the latest
+``max_delta_depth`` checkpoints never deletes a referenced chunk.
+"""
+
+import hashlib
+import io
+import logging
+import pickle
+from collections import defaultdict
+
+import numpy
+import torch
+import torchelastic.metrics as metrics
+
+from .mmap_format import _NUMPY_DTYPE_BY_NAME
+
+
+log = logging.getLogger(__name__)
+
+DELTA_MANIFEST_CHECKPOINT_KEY = "delta_manifest"
+_CHUNKS_CHECKPOINT_KEY = "chunks"
+_DELTA_CHECKPOINT_VERSION = 1
+_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def _hash_chunk(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _as_bytes(tensor):
+    """
+    Returns the memory of the (contiguous, cpu) tensor as a flat uint8 array.
+    """
+    return tensor.numpy().reshape(-1).view(numpy.uint8)
+
+
+class _DeltaPickler(pickle.Pickler):
+    """
+    Pickles everything but tensors, whose chunks that are not in
+    ``previous_chunks`` are written to ``stream``.
+    """
+
+    def __init__(self, file, stream, sequence_id, previous_chunks, max_delta_depth):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.stream = stream
+        self.sequence_id = sequence_id
+        self.previous_chunks = previous_chunks
+        self.max_delta_depth = max_delta_depth
+        # hash -> (sequence_id, offset, length) of the chunks referenced
+        self.chunks = {}
+        self.offset = 0
+        self.total_bytes = 0
+
+    def _add_chunk(self, data):
+        chunk_hash = _hash_chunk(data)
+        if chunk_hash in self.chunks:
+            return chunk_hash
+
+        previous = self.previous_chunks.get(chunk_hash)
+        if previous and previous[0] > self.sequence_id - self.max_delta_depth:
+            self.chunks[chunk_hash] = previous
+        else:
+            self.stream.write(data)
+            self.chunks[chunk_hash] = (self.sequence_id, self.offset, len(data))
+            self.offset += len(data)
+        return chunk_hash
+
+    def persistent_id(self, obj):
+        if not isinstance(obj, torch.Tensor):
+            return None
+
+        dtype = str(obj.dtype)
+        if dtype not in _NUMPY_DTYPE_BY_NAME:
+            raise ValueError(f"Unsupported tensor dtype: {dtype}")
+
+        tensor = obj.detach().cpu().contiguous()
+        data = _as_bytes(tensor)
+        self.total_bytes += len(data)
+        chunk_hashes = [
+            self._add_chunk(data[i : i + _CHUNK_SIZE].data)
+            for i in range(0, len(data), _CHUNK_SIZE)
+        ]
+        return (
+            "tensor",
+            dtype,
+            tuple(tensor.shape),
+            chunk_hashes,
+            obj.requires_grad,
+            isinstance(obj, torch.nn.Parameter),
+        )
+
+
+class _DeltaUnpickler(pickle.Unpickler):
+    """
+    Allocates the tensors of the snapshot and records where each chunk
+    needs to be copied to, the data is filled in afterwards.
+    """
+
+    def __init__(self, file):
+        super().__init__(file)
+        # hash -> [(destination uint8 array, position)]
+        self.destinations = defaultdict(list)
+
+    def persistent_load(self, pid):
+        _, dtype, shape, chunk_hashes, requires_grad, is_parameter = pid
+        tensor = torch.empty(shape, dtype=getattr(torch, dtype.split(".")[1]))
+        data = _as_bytes(tensor)
+        for i, chunk_hash in enumerate(chunk_hashes):
+            self.destinations[chunk_hash].append((data, i * _CHUNK_SIZE))
+
+        if is_parameter:
+            return torch.nn.Parameter(tensor, requires_grad=requires_grad)
+        return tensor.requires_grad_(requires_grad)
+
+
+@metrics.profile("torchelastic")
+def save_incremental_checkpoint(checkpoint, snapshot, previous_chunks, max_delta_depth):
+    """
+    Writes ``snapshot`` to ``checkpoint`` (does not commit it), only writing
+    the chunks that cannot be referenced from ``previous_chunks`` (the chunk
+    table returned for the previous checkpoint).
+
+    Returns the chunk table of ``checkpoint``.
+    """
+    header = io.BytesIO()
+    with checkpoint.open_output_stream(_CHUNKS_CHECKPOINT_KEY) as stream:
+        pickler = _DeltaPickler(
+            header, stream, checkpoint.sequence_id, previous_chunks, max_delta_depth
+        )
+        pickler.dump(snapshot)
+
+    manifest = {
+        "version": _DELTA_CHECKPOINT_VERSION,
+        "snapshot": header.getvalue(),
+        "chunks": pickler.chunks,
+    }
+    with checkpoint.open_output_stream(DELTA_MANIFEST_CHECKPOINT_KEY) as stream:
+        pickle.dump(manifest, stream, protocol=pickle.HIGHEST_PROTOCOL)
+
+    log.info(
+        f"Wrote {pickler.offset} of {pickler.total_bytes} tensor bytes"
+        f" to incremental checkpoint {checkpoint.sequence_id}"
+    )
+    metrics.publish_metric(
+        "torchelastic", "incremental_checkpoint.bytes_written", pickler.offset
+    )
+    return pickler.chunks
+
+
+def read_delta_manifest(checkpoint):
+    """
+    Returns the manifest of an incremental checkpoint or ``None`` if
+    ``checkpoint`` is not incremental.
+    """
+    try:
+        stream = checkpoint.open_input_stream(DELTA_MANIFEST_CHECKPOINT_KEY)
+    except Exception:
+        return None
+    with stream:
+        return pickle.load(stream)
+
+
+@metrics.profile("torchelastic")
+def load_incremental_checkpoint(checkpoint_manager, manifest):
+    """
+    Restores the snapshot described by ``manifest``, reading each referenced
+    chunk once, in offset order, from the checkpoint that holds it.
+    """
+    unpickler = _DeltaUnpickler(io.BytesIO(manifest["snapshot"]))
+    snapshot = unpickler.load()
+
+    chunks_by_sequence_id = defaultdict(list)
+    for chunk_hash, (sequence_id, offset, length) in manifest["chunks"].items():
+        chunks_by_sequence_id[sequence_id].append((offset, length, chunk_hash))
+
+    for sequence_id, chunks in chunks_by_sequence_id.items():
+        checkpoint = checkpoint_manager.get_checkpoint(sequence_id)
+        with checkpoint.open_input_stream(_CHUNKS_CHECKPOINT_KEY) as stream:
+            position = 0
+            for offset, length, chunk_hash in sorted(chunks):
+                # skip over chunks that are no longer referenced
+                if stream.seekable():
+                    stream.seek(offset)
+                else:
+                    stream.read(offset - position)
+                data = numpy.frombuffer(stream.read(length), dtype=numpy.uint8)
+                position = offset + length
+                for destination, start in unpickler.destinations[chunk_hash]:
+                    destination[start : start + length] = data
+
+    return snapshot
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+A tensor-aware checkpoint format that is loaded via ``mmap``.
+
+Unlike ``torch.save``, the tensor data is written as raw (aligned) bytes after
+a small pickled header. ``load`` maps the file into memory and returns CPU
+tensors that are backed directly by the mapped pages (copy-on-write), so
+restoring a checkpoint only reads the data that is actually touched and does
+not hold a second copy of the checkpoint in Python buffers.
+
+Usage (e.g. in a ``State``):
+
+ >>> from torchelastic.checkpoint import mmap_format
+ >>> def save(self, stream):
+ ...    mmap_format.save(self.capture_snapshot(), stream)
+ ...
+ >>> def load(self, stream):
+ ...    self.apply_snapshot(mmap_format.load(stream))
+
+NOTE: tensors are always loaded on the CPU and tensors that share storage
+      are saved (and loaded) as separate copies.
+"""
+
+import io
+import logging
+import pickle
+import struct
+
+import numpy
+import torch
+
+
+log = logging.getLogger(__name__)
+
+_MAGIC = b"TEMMAP01"
+# little endian uint64s holding the lengths of the pickled header and the data
+_LENGTHS_FORMAT = "<QQ"
+_PREFIX_SIZE = len(_MAGIC) + struct.calcsize(_LENGTHS_FORMAT)
+# tensor data is aligned so that the mapped arrays are aligned for any dtype
+_ALIGNMENT = 64
+
+_TORCH_TO_NUMPY_DTYPE = {
+    torch.bool: numpy.bool_,
+    torch.uint8: numpy.uint8,
+    torch.int8: numpy.int8,
+    torch.int16: numpy.int16,
+    torch.int32: numpy.int32,
+    torch.int64: numpy.int64,
+    torch.float16: numpy.float16,
+    torch.float32: numpy.float32,
+    torch.float64: numpy.float64,
+}
+_NUMPY_DTYPE_BY_NAME = {str(k): v for k, v in _TORCH_TO_NUMPY_DTYPE.items()}
+
+
+def _align(offset):
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+class _TensorPickler(pickle.Pickler):
+    """
+    Pickles everything but tensors, which are replaced by a reference to
+    their (aligned) offset in the data section.
+    """
+
+    def __init__(self, file):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.tensors = []
+        self.data_size = 0
+
+    def persistent_id(self, obj):
+        if not isinstance(obj, torch.Tensor):
+            return None
+
+        dtype = str(obj.dtype)
+        if dtype not in _NUMPY_DTYPE_BY_NAME:
+            raise ValueError(f"Unsupported tensor dtype: {dtype}")
+
+        tensor = obj.detach().cpu().contiguous()
+        nbytes = tensor.numel() * tensor.element_size()
+        offset = _align(self.data_size)
+        self.data_size = offset + nbytes
+        self.tensors.append((offset, tensor))
+        return (
+            "tensor",
+            dtype,
+            tuple(tensor.shape),
+            offset,
+            nbytes,
+            obj.requires_grad,
+            isinstance(obj, torch.nn.Parameter),
+        )
+
+
+class _TensorUnpickler(pickle.Unpickler):
+    def __init__(self, file, data):
+        super().__init__(file)
+        self.data = data
+
+    def persistent_load(self, pid):
+        _, dtype, shape, offset, nbytes, requires_grad, is_parameter = pid
+        array = self.data[offset : offset + nbytes]
+        array = array.view(_NUMPY_DTYPE_BY_NAME[dtype]).reshape(shape)
+        tensor = torch.from_numpy(array)
+        if is_parameter:
+            return torch.nn.Parameter(tensor, requires_grad=requires_grad)
+        return tensor.requires_grad_(requires_grad)
+
+
+def save(obj, stream) -> None:
+    """
+    Writes ``obj`` (any picklable object that may contain tensors) to the
+    binary file-like ``stream``.
+    """
+    header_buffer = io.BytesIO()
+    pickler = _TensorPickler(header_buffer)
+    pickler.dump(obj)
+    header = header_buffer.getbuffer()
+
+    stream.write(_MAGIC)
+    stream.write(struct.pack(_LENGTHS_FORMAT, len(header), pickler.data_size))
+    stream.write(header)
+    written = _PREFIX_SIZE + len(header)
+
+    data_start = _align(written)
+    stream.write(b"\0" * (data_start - written))
+    position = 0
+    for offset, tensor in pickler.tensors:
+        stream.write(b"\0" * (offset - position))
+        # writes the tensor's memory as is, without an intermediate copy
+        stream.write(tensor.numpy().reshape(-1).view(numpy.uint8).data)
+        position = offset + tensor.numel() * tensor.element_size()
+
+
+def _map_data(stream, header_end, data_start, data_size):
+    try:
+        fileno = stream.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        fileno = None
+
+    if data_size == 0:
+        return numpy.empty(0, dtype=numpy.uint8)
+    elif fileno is not None:
+        return numpy.memmap(
+            stream, dtype=numpy.uint8, mode="c", offset=data_start, shape=data_size
+        )
+    else:
+        # not backed by a file (e.g. an in-memory or network stream), fall back
+        # to a single read into a buffer shared by all tensors
+        log.debug("Stream does not support mmap, reading tensor data into memory")
+        stream.read(data_start - header_end)
+        data = bytearray(data_size)
+        stream.readinto(data)
+        return numpy.frombuffer(data, dtype=numpy.uint8)
+
+
+def load(stream):
+    """
+    Reads an object written by ``save`` from the binary file-like ``stream``.
+    If ``stream`` is backed by a file, the returned tensors are backed by the
+    memory mapped file and remain valid after ``stream`` is closed.
+    """
+    magic = stream.read(len(_MAGIC))
+    if magic != _MAGIC:
+        raise ValueError("Not an mmap_format checkpoint")
+    header_len, data_size = struct.unpack(
+        _LENGTHS_FORMAT, stream.read(struct.calcsize(_LENGTHS_FORMAT))
+    )
+    header = stream.read(header_len)
+    header_end = _PREFIX_SIZE + header_len
+    data_start = _align(header_end)
+
+    data = _map_data(stream, header_end, data_start, data_size)
+    return _TensorUnpickler(io.BytesIO(header), data).load()
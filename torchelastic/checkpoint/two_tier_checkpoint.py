@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torchelastic.metrics as metrics
+
+from .api import Checkpoint, CheckpointManager
+from .file_system_checkpoint import _COMPLETE_MARKER, FileSystemCheckpointManager
+
+
+log = logging.getLogger(__name__)
+
+
+class TwoTierCheckpointManager(CheckpointManager):
+    """
+    A CheckpointManager that writes checkpoints to a fast local tier
+    (e.g. tmpfs or a local NVMe disk) and drains them to a durable tier
+    (e.g. a network file system) in the background.
+
+    ``commit()`` returns as soon as the checkpoint is committed to the local
+    tier. Committed checkpoints are then copied to the durable tier by a
+    background thread, in order. If checkpoints are committed faster than
+    they can be drained, only the latest pending checkpoint is drained.
+
+    ``get_latest_checkpoint`` returns the newer of the latest local and the
+    latest durable checkpoint (preferring the local tier on a tie), so that
+    a restart on the same host restores from the local tier, while a restart
+    on a different host restores from the durable tier. Local checkpoints
+    that were not drained yet (e.g. because the process died) are drained
+    when the manager is created.
+
+    ``local_max_to_keep``   - number of drained checkpoints kept in the local
+                              tier (defaults to 1).
+    ``durable_max_to_keep`` - see ``FileSystemCheckpointManager.max_to_keep``.
+
+    NOTE: the local tier is private to the host, hence every checkpoint must
+          be written from a single host (this rules out ``sharded``
+          checkpoints on jobs that span multiple hosts).
+    """
+
+    def __init__(
+        self, local_dir, durable_dir, local_max_to_keep=1, durable_max_to_keep=None
+    ):
+        if local_max_to_keep < 1:
+            raise ValueError("local_max_to_keep must be at least 1")
+
+        self.local_checkpoint_manager = FileSystemCheckpointManager(local_dir)
+        self.durable_checkpoint_manager = FileSystemCheckpointManager(
+            durable_dir, max_to_keep=durable_max_to_keep
+        )
+        self._local_max_to_keep = local_max_to_keep
+        self._drain_executor = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+        self._pending_drains = []
+        self._latest_local_commit = -1
+
+        local_latest = self.local_checkpoint_manager.get_latest_checkpoint()
+        durable_latest = self.durable_checkpoint_manager.get_latest_checkpoint()
+        if local_latest and (
+            durable_latest is None
+            or local_latest.sequence_id > durable_latest.sequence_id
+        ):
+            log.info(f"Draining checkpoint {local_latest.sequence_id} from last run")
+            self._on_local_commit(local_latest.sequence_id)
+
+    def _get_latest_durable_sequence_id(self):
+        seq_ids = self.durable_checkpoint_manager._get_complete_sequence_ids()
+        return seq_ids[0] if seq_ids else -1
+
+    def create_checkpoint(self):
+        # never reuse a sequence id that is already in the durable tier
+        # (e.g. written from a different host)
+        local_checkpoint = self.local_checkpoint_manager._create_checkpoint(
+            min_sequence_id=self._get_latest_durable_sequence_id() + 1
+        )
+        return TwoTierCheckpoint(self, local_checkpoint)
+
+    def get_checkpoint(self, sequence_id):
+        try:
+            checkpoint = self.local_checkpoint_manager.get_checkpoint(sequence_id)
+        except Exception:
+            checkpoint = self.durable_checkpoint_manager.get_checkpoint(sequence_id)
+        return TwoTierCheckpoint(self, checkpoint)
+
+    def get_latest_checkpoint(self):
+        local_latest = self.local_checkpoint_manager.get_latest_checkpoint()
+        durable_latest = self.durable_checkpoint_manager.get_latest_checkpoint()
+        if local_latest is None and durable_latest is None:
+            return None
+        if durable_latest is None or (
+            local_latest and local_latest.sequence_id >= durable_latest.sequence_id
+        ):
+            log.info(f"Latest checkpoint {local_latest.sequence_id} is in local tier")
+            return TwoTierCheckpoint(self, local_latest)
+        return TwoTierCheckpoint(self, durable_latest)
+
+    def list_checkpoints(self):
+        checkpoints = {
+            c.sequence_id: c for c in self.durable_checkpoint_manager.list_checkpoints()
+        }
+        for c in self.local_checkpoint_manager.list_checkpoints():
+            checkpoints[c.sequence_id] = c
+        return [
+            TwoTierCheckpoint(self, checkpoints[id])
+            for id in sorted(checkpoints, reverse=True)
+        ]
+
+    def wait_for_drain(self):
+        """
+        Blocks until all checkpoints committed so far are drained (or
+        skipped in favor of a newer one).
+        """
+        with self._lock:
+            pending_drains = list(self._pending_drains)
+        for pending_drain in pending_drains:
+            pending_drain.result()
+
+    def _on_local_commit(self, sequence_id):
+        with self._lock:
+            self._latest_local_commit = max(self._latest_local_commit, sequence_id)
+            self._pending_drains = [f for f in self._pending_drains if not f.done()]
+            self._pending_drains.append(
+                self._drain_executor.submit(self._drain, sequence_id)
+            )
+
+    def _drain(self, sequence_id):
+        if sequence_id < self._latest_local_commit:
+            log.info(f"Skip draining checkpoint {sequence_id}, a newer one is pending")
+            return
+
+        try:
+            self._copy_to_durable(sequence_id)
+        except Exception as e:
+            # the checkpoint stays in the local tier
+            log.error(f"Drain checkpoint {sequence_id} fail: {e}")
+            return
+        self._prune_local(sequence_id)
+
+    @metrics.profile("torchelastic")
+    def _copy_to_durable(self, sequence_id):
+        local_checkpoint = self.local_checkpoint_manager.get_checkpoint(sequence_id)
+        durable_checkpoint = self.durable_checkpoint_manager._create_checkpoint(
+            min_sequence_id=sequence_id
+        )
+        if durable_checkpoint.sequence_id != sequence_id:
+            # the durable tier moved ahead (e.g. written from a different host)
+            log.warning(
+                f"Draining checkpoint {sequence_id} as durable checkpoint"
+                f" {durable_checkpoint.sequence_id}"
+            )
+
+        try:
+            for key in sorted(os.listdir(local_checkpoint.checkpoint_dir)):
+                if key == _COMPLETE_MARKER:
+                    continue
+                with local_checkpoint.open_input_stream(key) as src:
+                    with durable_checkpoint.open_output_stream(key) as dst:
+                        shutil.copyfileobj(src, dst)
+            durable_checkpoint.commit()
+            log.info(f"Drained checkpoint {sequence_id} to durable tier")
+        except Exception:
+            durable_checkpoint.discard()
+            raise
+
+    def _prune_local(self, drained_sequence_id):
+        """
+        Removes drained local checkpoints but the latest ``local_max_to_keep``.
+        """
+        seq_ids = self.local_checkpoint_manager._get_sequence_ids()
+        expired_ids = [
+            id for id in seq_ids[self._local_max_to_keep :] if id <= drained_sequence_id
+        ]
+        if expired_ids:
+            self.local_checkpoint_manager._remove_checkpoints(expired_ids)
+
+
+class TwoTierCheckpoint(Checkpoint):
+    """
+    A checkpoint in either tier of a ``TwoTierCheckpointManager``.
+    """
+
+    def __init__(self, checkpoint_manager, checkpoint):
+        self.sequence_id = checkpoint.sequence_id
+        self._checkpoint_manager = checkpoint_manager
+        self._checkpoint = checkpoint
+
+    def open_output_stream(self, key):
+        return self._checkpoint.open_output_stream(key)
+
+    def open_input_stream(self, key):
+        return self._checkpoint.open_input_stream(key)
+
+    def commit(self):
+        """
+        Commits the checkpoint to the local tier and schedules
+        it to be drained to the durable tier.
+        """
+        if self._checkpoint._committed:
+            return
+        self._checkpoint.commit()
+        self._checkpoint_manager._on_local_commit(self.sequence_id)
+
+    def discard(self):
+        self._checkpoint.discard()
@@ -16,3 +16,13 @@ def get_rank():
     / non-distributed settings
     """
     return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+
+def get_world_size():
+    """
+    Simple wrapper for correctly getting world size in both distributed
+    / non-distributed settings
+    """
+    return (
+        dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+    )
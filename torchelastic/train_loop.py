@@ -135,6 +135,9 @@ def train(elastic_coordinator, train_step, state):
                     get_elapsed_time_ms(start_time),
                 )
 
+    # make sure the last checkpoint is durable before handing control back
+    checkpoint_util.wait_for_pending_save()
+
     if elastic_coordinator.should_stop_training():
         return state
     else: